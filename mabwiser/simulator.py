@@ -9,8 +9,8 @@ import abc
 import logging
 from copy import deepcopy
 from collections import defaultdict
-from itertools import chain
-from typing import Union, List, Optional, NoReturn
+from functools import partial
+from typing import Union, List, Optional, NoReturn, NamedTuple
 
 import math
 import matplotlib.pyplot as plt
@@ -19,7 +19,6 @@ import pandas as pd
 import seaborn as sns
 from joblib import Parallel, delayed
 from scipy.spatial.distance import cdist
-from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import train_test_split
 
 from mabwiser.base_mab import BaseMAB
@@ -82,35 +81,59 @@ def default_evaluator(arms: List[Arm], decisions: np.ndarray, rewards: np.ndarra
     An arm_to_stats dictionary for the predictions in the batch.
     Dictionary has the format {arm {'count', 'sum', 'min', 'max', 'mean', 'std'}}
     """
-    # If decision and prediction matches each other, use the observed reward
-    # If decision and prediction are different, use the given stat (e.g., mean) for the arm as the reward
+    return _default_evaluator_stats(arms, decisions, rewards, predictions, arm_to_stats, [stat], start_index, nn)[stat]
+
+
+def _default_evaluator_stats(arms: List[Arm], decisions: np.ndarray, rewards: np.ndarray, predictions: List[Arm],
+                             arm_to_stats: dict, stats: List[str], start_index: int, nn: bool = False) -> dict:
+    """Default evaluation function for several statistics at once.
+
+    Gives the same results as calling the default evaluator for each of the given stats,
+    but matches the predictions with the historic decisions, and with the statistics to use otherwise, only once.
 
-    arm_to_rewards = dict((arm, []) for arm in arms)
+    Returns
+    -------
+    A dictionary from each of the given stats to the arm_to_stats dictionary of the default evaluator for that stat.
+    """
+    # If decision and prediction matches each other, use the observed reward
+    # If decision and prediction are different, keep the descriptive statistics the given stats are read from
+    arm_to_sources = dict((arm, []) for arm in arms)
     if nn:
         arm_to_stats, neighborhood_stats = arm_to_stats
     for index, predicted_arm in enumerate(predictions):
 
         if predicted_arm == decisions[index]:
-            arm_to_rewards[predicted_arm].append(rewards[index])
+            arm_to_sources[predicted_arm].append(rewards[index])
         elif nn:
             nn_index = index + start_index
             row_neighborhood_stats = neighborhood_stats[nn_index]
             if row_neighborhood_stats and row_neighborhood_stats[predicted_arm]:
-                arm_to_rewards[predicted_arm].append(row_neighborhood_stats[predicted_arm][stat])
+                arm_to_sources[predicted_arm].append(row_neighborhood_stats[predicted_arm])
             else:
-                arm_to_rewards[predicted_arm].append(arm_to_stats[predicted_arm][stat])
+                arm_to_sources[predicted_arm].append(arm_to_stats[predicted_arm])
 
         else:
-            arm_to_rewards[predicted_arm].append(arm_to_stats[predicted_arm][stat])
+            arm_to_sources[predicted_arm].append(arm_to_stats[predicted_arm])
 
-    # Calculate stats based on the rewards from predicted arms
+    # Calculate stats based on the rewards from predicted arms for each of the given stats
+    stat_to_arm_to_stats = {}
+    for stat in stats:
+        arm_to_rewards = dict((arm, [source[stat] if isinstance(source, dict) else source for source in sources])
+                              for arm, sources in arm_to_sources.items())
+        stat_to_arm_to_stats[stat] = _get_arm_to_stats_prediction(arms, arm_to_rewards)
+
+    return stat_to_arm_to_stats
+
+
+def _get_arm_to_stats_prediction(arms: List[Arm], arm_to_rewards: dict) -> dict:
+    """Calculates the descriptive statistics of the rewards of each arm, or nan when an arm has no rewards."""
     arm_to_stats_prediction = {}
     for arm in arms:
-        arm_to_rewards[arm] = np.array(arm_to_rewards[arm])
-        if len(arm_to_rewards[arm]) > 0:
-            arm_to_stats_prediction[arm] = {'count': arm_to_rewards[arm].size, 'sum': arm_to_rewards[arm].sum(),
-                                            'min': arm_to_rewards[arm].min(), 'max': arm_to_rewards[arm].max(),
-                                            'mean': arm_to_rewards[arm].mean(), 'std': arm_to_rewards[arm].std()}
+        arm_rewards = np.array(arm_to_rewards[arm])
+        if len(arm_rewards) > 0:
+            arm_to_stats_prediction[arm] = {'count': arm_rewards.size, 'sum': arm_rewards.sum(),
+                                            'min': arm_rewards.min(), 'max': arm_rewards.max(),
+                                            'mean': arm_rewards.mean(), 'std': arm_rewards.std()}
         else:
             arm_to_stats_prediction[arm] = {'count': 0, 'sum': math.nan,
                                             'min': math.nan, 'max': math.nan,
@@ -120,6 +143,15 @@ def default_evaluator(arms: List[Arm], decisions: np.ndarray, rewards: np.ndarra
 
 
 class _NeighborsSimulator(_Neighbors):
+    """Nearest Neighbors bandit that shares the distances calculated by the simulator.
+
+    Attributes
+    ----------
+    input_dependent_metrics: List[str]
+        The distance metrics whose parameters are estimated from the given contexts.
+    """
+
+    input_dependent_metrics = ["mahalanobis", "seuclidean"]
 
     def __init__(self, rng: _BaseRNG, arms: List[Arm], n_jobs: int, backend: Optional[str],
                  lp: Union[_EpsilonGreedy, _Linear, _Popularity, _Random, _Softmax, _ThompsonSampling, _UCB1],
@@ -157,14 +189,26 @@ class _NeighborsSimulator(_Neighbors):
         # Partition contexts by job
         n_jobs, n_contexts, starts = self._partition_contexts(len(contexts))
 
-        # Calculate distances in parallel
-        distances = Parallel(n_jobs=n_jobs, backend=self.backend)(
-                             delayed(self._calculate_distances_of_batch)(
-                                     contexts[starts[i]:starts[i + 1]])
-                             for i in range(n_jobs))
+        # Metrics that estimate their parameters from the inputs loop over the rows in Python,
+        # so their blocks are calculated in parallel and concatenated, the same as when a backend is given
+        if self.metric in _NeighborsSimulator.input_dependent_metrics or self.backend is not None:
+            distances = Parallel(n_jobs=n_jobs, backend=self.backend)(
+                                 delayed(self._calculate_distances_of_batch)(
+                                         contexts[starts[i]:starts[i + 1]])
+                                 for i in range(n_jobs))
+
+            # Reduce
+            # Each row of the distance matrix holds the distances of a context to the historical contexts
+            self.distances = np.concatenate(distances)
 
-        # Reduce
-        self.distances = list(chain.from_iterable(t for t in distances))
+        # Otherwise, a single cdist call over a batch releases the GIL, so the jobs run in threads that share
+        # the historical contexts and write their rows directly into the distance matrix, which is allocated once
+        else:
+            self.distances = np.empty((len(contexts), len(self.contexts)))
+            Parallel(n_jobs=n_jobs, require='sharedmem')(
+                     delayed(cdist)(contexts[starts[i]:starts[i + 1]], self.contexts, metric=self.metric,
+                                    out=self.distances[starts[i]:starts[i + 1]])
+                     for i in range(n_jobs))
 
         return self.distances
 
@@ -172,9 +216,11 @@ class _NeighborsSimulator(_Neighbors):
         self.distances = distances
 
     def _calculate_distances_of_batch(self, contexts: np.ndarray):
-        distances = [None] * len(contexts)
+
+        # Metrics that estimate their parameters from the inputs, e.g. the variances for seuclidean,
+        # depend on the contexts given together, so calculate them one row at a time
+        distances = np.empty((len(contexts), len(self.contexts)))
         for index, row in enumerate(contexts):
-            # Calculate the distances from the historical contexts
             # Row is 1D so convert it to 2D array for cdist using newaxis
             # Finally, reshape to flatten the output distances list
             row_2d = row[np.newaxis, :]
@@ -189,12 +235,12 @@ class _NeighborsSimulator(_Neighbors):
             df = pd.DataFrame(out, columns=['prediction', 'expectations', 'size', 'stats'])
 
             if is_predict:
-                self.row_arm_to_expectation = self.row_arm_to_expectation + df['expectations'].tolist()
+                self.row_arm_to_expectation.extend(df['expectations'].tolist())
             else:
-                self.row_arm_to_expectation = self.row_arm_to_expectation + df['prediction'].tolist()
+                self.row_arm_to_expectation.extend(df['prediction'].tolist())
             if not self.is_quick:
-                self.neighborhood_sizes = self.neighborhood_sizes + df['size'].tolist()
-                self.neighborhood_arm_to_stat = self.neighborhood_arm_to_stat + df['stats'].tolist()
+                self.neighborhood_sizes.extend(df['size'].tolist())
+                self.neighborhood_arm_to_stat.extend(df['stats'].tolist())
 
             return df['prediction'].tolist()
 
@@ -202,12 +248,12 @@ class _NeighborsSimulator(_Neighbors):
         else:
             prediction, expectation, size, stats = out
             if is_predict:
-                self.row_arm_to_expectation = self.row_arm_to_expectation + [expectation]
+                self.row_arm_to_expectation.append(expectation)
             else:
-                self.row_arm_to_expectation = self.row_arm_to_expectation + [prediction]
+                self.row_arm_to_expectation.append(prediction)
             if not self.is_quick:
-                self.neighborhood_sizes = self.neighborhood_sizes + [size]
-                self.neighborhood_arm_to_stat = self.neighborhood_arm_to_stat + [stats]
+                self.neighborhood_sizes.append(size)
+                self.neighborhood_arm_to_stat.append(stats)
             return prediction
 
     def _get_nhood_predictions(self, lp, row_2d, indices, is_predict):
@@ -364,18 +410,17 @@ class _ApproximateSimulator(_NeighborsSimulator, metaclass=abc.ABCMeta):
         # Create an empty list of predictions
         predictions = [None] * len(contexts)
 
+        # Get the neighbors of all the given contexts at once
+        row_to_indices = self._get_neighbors_of_contexts(contexts)
+
         # For each row in the given contexts
         for index, row in enumerate(contexts):
 
             # Get random generator
             lp.rng = create_rng(seed=seeds[index])
 
-            # Prepare for hashing
             row_2d = row[np.newaxis, :]
-            indices = self._get_neighbors(row_2d)
-
-            # Drop duplicates from list of neighbors
-            indices = list(set(indices))
+            indices = row_to_indices[index]
 
             # If neighbors exist
             if len(indices) > 0:
@@ -391,6 +436,10 @@ class _ApproximateSimulator(_NeighborsSimulator, metaclass=abc.ABCMeta):
 
         return predictions
 
+    def _get_neighbors_of_contexts(self, contexts):
+        # Get the neighbors of each row, and drop duplicates from the list of neighbors
+        return [list(set(self._get_neighbors(row[np.newaxis, :]))) for row in contexts]
+
     @abc.abstractmethod
     def _get_neighbors(self, row_2d):
         """Abstract method to be implemented by child classes."""
@@ -422,13 +471,6 @@ class _LSHSimulator(_ApproximateSimulator):
         self.table_to_hash_to_index = {k: defaultdict(list) for k in range(self.n_tables)}
         self.table_to_plane = {i: [] for i in range(self.n_tables)}
 
-    def _add_neighbors(self, hash_values, k, h, context_start):
-        if context_start > 0:
-            neighbors = np.where(hash_values == h)[0] + context_start
-        else:
-            neighbors = np.where(hash_values == h)[0]
-        self.table_to_hash_to_index[k][h] += list(neighbors)
-
     def _fit_operation(self, contexts, context_start):
         # Get hashes for each hash table for each training context
         for k in self.table_to_plane.keys():
@@ -446,16 +488,14 @@ class _LSHSimulator(_ApproximateSimulator):
                 for i in range(n_jobs))
 
             # Reduce
-            hash_values = list(chain.from_iterable(t for t in hash_values))
-
-            # Get list of unique hashes - list is sparse, there should be collisions
-            hash_keys = np.unique(hash_values)
+            hash_values = np.concatenate(hash_values)
 
-            # For each hash, get the indices of contexts with that hash
-            Parallel(n_jobs=n_jobs, require='sharedmem')(
-                delayed(self._add_neighbors)(
-                    hash_values, k, h, context_start)
-                for h in hash_keys)
+            # Group the indices of the contexts by hash with a single stable sort,
+            # instead of scanning all the hashes for each unique hash - there should be collisions
+            order = np.argsort(hash_values, kind='stable')
+            hash_keys, counts = np.unique(hash_values[order], return_counts=True)
+            for h, neighbors in zip(hash_keys, np.split(order + context_start, np.cumsum(counts)[:-1])):
+                self.table_to_hash_to_index[k][h] += list(neighbors)
 
     def _initialize(self, n_rows):
         self.table_to_plane = {i: self.rng.standard_normal(size=(n_rows, self.n_dimensions))
@@ -470,6 +510,53 @@ class _LSHSimulator(_ApproximateSimulator):
             indices += self.table_to_hash_to_index[k][hash_value[0]]
         return indices
 
+    def _get_neighbors_of_contexts(self, contexts):
+
+        # Hash all contexts for each hash table at once, with a column of hash values for each table
+        hash_values = np.column_stack([_LSHNearest.get_context_hash(contexts, self.table_to_plane[k])
+                                       for k in self.table_to_plane.keys()])
+
+        # Contexts with the same hash values in every table have the same neighbors,
+        # so get the neighbors once for each unique combination of hash values
+        unique_hash_values, row_to_unique = np.unique(hash_values, axis=0, return_inverse=True)
+        unique_to_indices = []
+        for row_hash_values in unique_hash_values:
+            indices = list()
+            for k, hash_value in zip(self.table_to_plane.keys(), row_hash_values):
+                indices += self.table_to_hash_to_index[k][hash_value]
+
+            # Drop duplicates from list of neighbors
+            unique_to_indices.append(list(set(indices)))
+
+        return [unique_to_indices[i] for i in row_to_unique.reshape(-1)]
+
+
+class _BanditKind(NamedTuple):
+    """The types of a bandit in the simulation, which do not change while testing.
+
+    Attributes
+    ----------
+    name: str
+        The name of the bandit.
+    mab: Union[MAB, _NeighborsSimulator]
+        The bandit.
+    is_contextual: bool
+        Whether the bandit uses contexts.
+    has_row_expectations: bool
+        Whether the bandit is a neighbors simulator, which keeps the expectations of each row it predicts.
+    is_neighbors: bool
+        Whether the bandit is a contextual neighbors bandit that is not simulated, with a single expectation.
+    is_nn: bool
+        Whether the bandit is a neighbors simulator, which keeps the statistics of its neighborhoods.
+    """
+
+    name: str
+    mab: Union[MAB, _NeighborsSimulator]
+    is_contextual: bool
+    has_row_expectations: bool
+    is_neighbors: bool
+    is_nn: bool
+
 
 class Simulator:
     """ Multi-Armed Bandit Simulator.
@@ -743,12 +830,23 @@ class Simulator:
         Arm_to_stats dictionary.
         Dictionary has the format {arm {'count', 'sum', 'min', 'max', 'mean', 'std'}}
         """
+        # Group the rewards by decision with a single sort
+        # so that the rewards of each arm are in a contiguous slice starting at the given offsets
+        arm_to_stats = {}
+        if len(decisions) > 0:
+            order = np.argsort(decisions, kind='stable')
+            sorted_decisions = decisions[order]
+            sorted_rewards = rewards[order]
+            arms_present, starts = np.unique(sorted_decisions, return_index=True)
+
+            # Calculate the statistics of each slice the same way as for the whole data set
+            for arm, arm_rewards in zip(arms_present.tolist(), np.split(sorted_rewards, starts[1:])):
+                arm_to_stats[arm] = self.get_stats(arm_rewards)
+
         stats = dict((arm, {}) for arm in self.arms)
         for arm in self.arms:
-            indices = np.where(decisions == arm)
-            if indices[0].shape[0] > 0:
-                arm_rewards = rewards[indices]
-                stats[arm] = self.get_stats(arm_rewards)
+            if arm in arm_to_stats:
+                stats[arm] = arm_to_stats[arm]
             else:
                 stats[arm] = {'count': 0, 'sum': 0, 'min': 0,
                               'max': 0, 'mean': 0, 'std': 0}
@@ -800,52 +898,24 @@ class Simulator:
             labels = {}
             mabs = []
 
-            if is_per_arm:
-                for mab_name, mab in self.bandits:
-                    self.logger.info('Plotting ' + str(mab_name))
-                    for arm in self.arms:
+            for mab_name, mab in self.bandits:
+                self.logger.info('Plotting ' + str(mab_name))
+
+                # Batch sums of the bandit with a row for each batch and a column for each arm
+                batches = [key for key in stats[mab_name].keys() if key != 'total']
+                batch_sums = np.array([[stats[mab_name][key][arm]['sum'] for arm in self.arms] for key in batches],
+                                      dtype=float).reshape(len(batches), len(self.arms))
+
+                if is_per_arm:
+                    for arm_index, arm in enumerate(self.arms):
                         mab_arm_name = str(mab_name) + '_' + str(arm)
                         mabs.append(mab_arm_name)
-                        labels[mab_arm_name] = []
-                        sums = []
-                        cu_sums[mab_arm_name] = []
-                        for key in stats[mab_name].keys():
-                            if key != 'total':
-                                labels[mab_arm_name].append(key)
-                                if np.isnan(stats[mab_name][key][arm]['sum']):
-                                    sums.append(0)
-                                else:
-                                    sums.append(stats[mab_name][key][arm]['sum'])
-                        cs = 0
-                        for item in sums:
-                            cs += item
-                            cu_sums[mab_arm_name].append(cs)
-            else:
-                for mab_name, mab in self.bandits:
-                    self.logger.info('Plotting ' + str(mab_name))
-
+                        labels[mab_arm_name] = batches
+                        cu_sums[mab_arm_name] = np.cumsum(np.nan_to_num(batch_sums[:, arm_index], nan=0.0)).tolist()
+                else:
                     mabs.append(mab_name)
-                    labels[mab_name] = []
-                    sums = []
-                    cu_sums[mab_name] = []
-
-                    for key in stats[mab_name].keys():
-                        if key != 'total':
-
-                            labels[mab_name].append(key)
-
-                            net = 0
-                            for arm in self.arms:
-                                if np.isnan(stats[mab_name][key][arm]['sum']):
-                                    continue
-
-                                net += stats[mab_name][key][arm]['sum']
-                            sums.append(net)
-                    cs = 0
-
-                    for item in sums:
-                        cs += item
-                        cu_sums[mab_name].append(cs)
+                    labels[mab_name] = batches
+                    cu_sums[mab_name] = np.cumsum(np.nansum(batch_sums, axis=1)).tolist()
 
             x = [i * self.batch_size for i in labels[mabs[0]]]
             for mab in mabs:
@@ -858,23 +928,17 @@ class Simulator:
             x_labels = []
             y_values = []
 
-            if is_per_arm:
-                for mab_name, mab in self.bandits:
-                    for arm in self.arms:
-                        x_labels.append(str(mab_name) + '_' + str(arm))
-                        if not np.isnan(stats[mab_name][arm]['sum']):
-                            y_values.append(stats[mab_name][arm]['sum'])
-                        else:
-                            y_values.append(0)
+            for mab_name, mab in self.bandits:
 
-            else:
-                for mab_name, mab in self.bandits:
+                # Sums of the bandit for each arm, where arms without predictions add nothing
+                sums = np.nan_to_num(np.array([stats[mab_name][arm]['sum'] for arm in self.arms], dtype=float), nan=0.0)
+
+                if is_per_arm:
+                    x_labels.extend(str(mab_name) + '_' + str(arm) for arm in self.arms)
+                    y_values.extend(sums.tolist())
+                else:
                     x_labels.append(mab_name)
-                    cumulative = 0
-                    for arm in self.arms:
-                        if not np.isnan(stats[mab_name][arm]['sum']):
-                            cumulative += stats[mab_name][arm]['sum']
-                    y_values.append(cumulative)
+                    y_values.append(sums.sum())
 
             plt.bar(x_labels, y_values)
             plt.xlabel('Bandit')
@@ -948,56 +1012,84 @@ class Simulator:
         self.logger.info('Simulation complete')
 
     # Private Methods
+    def _evaluate(self, name, decisions, rewards, predictions, start_index, nn=False):
+        """
+        Evaluates the predictions with the minimum, mean and maximum statistics of the training data,
+        or of the neighborhoods for the nearest neighbors simulators when is_quick is False.
+
+        Returns
+        -------
+        The tuple of arm_to_stats dictionaries for the min, mean and max statistics.
+        """
+        if nn and not self.is_quick:
+            arm_to_stats = (self.arm_to_stats_train, self.bandit_to_arm_to_stats_neighborhoods[name])
+        else:
+            arm_to_stats, nn = self.arm_to_stats_train, False
+
+        # The default evaluator finds the rewards of all stats in a single pass
+        if self.evaluator is default_evaluator:
+            stat_to_arm_to_stats = _default_evaluator_stats(self.arms, decisions, rewards, predictions, arm_to_stats,
+                                                            ["min", "mean", "max"], start_index, nn)
+            return stat_to_arm_to_stats["min"], stat_to_arm_to_stats["mean"], stat_to_arm_to_stats["max"]
+
+        # Bind the arguments that are the same for every stat once
+        evaluator = partial(self.evaluator, self.arms, decisions, rewards, predictions, arm_to_stats)
+        return tuple(evaluator(stat, start_index, nn) for stat in ["min", "mean", "max"])
+
     def _get_partial_evaluation(self, name, i, decisions, predictions, rewards, start_index, nn=False):
-        cfm = confusion_matrix(decisions, predictions)
+        cfm = self._get_confusion_matrix(decisions, predictions)
         self.bandit_to_confusion_matrices[name].append(cfm)
         self.logger.info(str(name) + ' batch ' + str(i) + ' confusion matrix: ' + str(cfm))
-        if nn and not self.is_quick:
-            self.bandit_to_arm_to_stats_min[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      (self.arm_to_stats_train,
-                                                                       self.bandit_to_arm_to_stats_neighborhoods[
-                                                                           name]),
-                                                                      "min", start_index, nn)
-
-            self.bandit_to_arm_to_stats_avg[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      (self.arm_to_stats_train,
-                                                                       self.bandit_to_arm_to_stats_neighborhoods[
-                                                                           name]),
-                                                                      "mean", start_index, nn)
-
-            self.bandit_to_arm_to_stats_max[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      (self.arm_to_stats_train,
-                                                                       self.bandit_to_arm_to_stats_neighborhoods[
-                                                                           name]),
-                                                                      "max", start_index, nn)
-        else:
-            self.bandit_to_arm_to_stats_min[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      self.arm_to_stats_train, "min",
-                                                                      start_index, False)
-
-            self.bandit_to_arm_to_stats_avg[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      self.arm_to_stats_train, "mean",
-                                                                      start_index, False)
-
-            self.bandit_to_arm_to_stats_max[name][i] = self.evaluator(self.arms,
-                                                                      decisions, rewards,
-                                                                      predictions,
-                                                                      self.arm_to_stats_train, "max",
-                                                                      start_index, False)
+        arm_to_stats_min, arm_to_stats_avg, arm_to_stats_max = self._evaluate(name, decisions, rewards, predictions,
+                                                                              start_index, nn)
+        self.bandit_to_arm_to_stats_min[name][i] = arm_to_stats_min
+        self.bandit_to_arm_to_stats_avg[name][i] = arm_to_stats_avg
+        self.bandit_to_arm_to_stats_max[name][i] = arm_to_stats_max
         self.logger.info(name + ' ' + str(self.bandit_to_arm_to_stats_min[name][i]))
         self.logger.info(name + ' ' + str(self.bandit_to_arm_to_stats_avg[name][i]))
         self.logger.info(name + ' ' + str(self.bandit_to_arm_to_stats_max[name][i]))
 
+    def _get_bandit_kinds(self):
+        """
+        Checks the types of the bandits, which do not change during the simulation.
+
+        Returns
+        -------
+        A list with the kind of each bandit, in the order of the bandits.
+        """
+        bandit_kinds = []
+        for name, mab in self.bandits:
+            has_row_expectations = isinstance(mab, (_RadiusSimulator, _KNearestSimulator, _LSHSimulator))
+            is_neighbors = mab.is_contextual and not has_row_expectations and isinstance(mab._imp, _Neighbors)
+            bandit_kinds.append(_BanditKind(name=name, mab=mab, is_contextual=mab.is_contextual,
+                                            has_row_expectations=has_row_expectations, is_neighbors=is_neighbors,
+                                            is_nn=isinstance(mab, _NeighborsSimulator)))
+        return bandit_kinds
+
+    def _get_metric_to_distance_bandits(self):
+        """
+        Groups the Radius and KNearest simulators, which share their distances, by their distance metric.
+
+        Returns
+        -------
+        A dictionary from each metric to the list of its bandits, in the order of the bandits.
+        """
+        metric_to_distance_bandits = defaultdict(list)
+        for name, mab in self.bandits:
+            if isinstance(mab, (_RadiusSimulator, _KNearestSimulator)):
+                metric_to_distance_bandits[mab.metric].append(mab)
+        return dict(metric_to_distance_bandits)
+
+    def _calculate_chunk_distances(self, metric_to_distance_bandits, contexts):
+        """
+        Calculates the distances of the given contexts once for each metric, and sets them on all of its bandits.
+        """
+        for distance_bandits in metric_to_distance_bandits.values():
+            distance_bandits[0].calculate_distances(contexts)
+            self.logger.info('Distances calculated')
+            for mab in distance_bandits[1:]:
+                mab.set_distances(distance_bandits[0].distances)
+
     def _offline_test_bandits(self, test_decisions, test_rewards, test_contexts):
         """
         Performs offline prediction.
@@ -1012,111 +1104,101 @@ class Simulator:
             The test set contexts.
         """
 
-        chunk_start_index = [idx for idx in range(int(math.ceil(len(test_decisions) / self._chunk_size)))]
-        for idx in chunk_start_index:
+        # The Radius and KNearest simulators share the same training contexts,
+        # so the distances of each chunk are calculated once for each metric and set on all of its bandits.
+        # When the distances of the whole test set fit in memory there is a single chunk,
+        # and the complete test-train distance matrix of each metric is calculated only once.
+        metric_to_distance_bandits = self._get_metric_to_distance_bandits()
+
+        # The types of the bandits do not change between chunks, so check them once
+        bandit_kinds = self._get_bandit_kinds()
+
+        # The predictions, and the expectations that are made for each test row,
+        # are written into arrays allocated once for the whole test set
+        n_test = len(test_decisions)
+        bandit_to_predictions = dict((kind.name, np.empty(n_test, dtype=object)) for kind in bandit_kinds)
+        bandit_to_row_expectations = dict((kind.name, np.empty(n_test, dtype=object)) for kind in bandit_kinds
+                                          if kind.is_contextual and not kind.is_neighbors)
+
+        # Context-free bandits are not updated offline and do not depend on the contexts, so predict the whole
+        # test set in one vectorized call using empty contexts, i.e. one row without features per decision.
+        # This keeps their seeded predictions independent of the chunk size.
+        contextual_kinds = []
+        for kind in bandit_kinds:
+            if kind.is_contextual:
+                contextual_kinds.append(kind)
+            else:
+                predictions = kind.mab.predict(np.empty((n_test, 0)))
+                bandit_to_predictions[kind.name][:] = predictions if n_test > 1 else [predictions]
+
+        # Split the test set into views of chunk size rows once
+        chunk_starts = list(range(0, len(test_decisions), self._chunk_size))
+        decision_chunks = np.array_split(test_decisions, chunk_starts[1:])
+        if test_contexts is not None:
+            context_chunks = np.array_split(test_contexts, chunk_starts[1:])
+        else:
+            context_chunks = [None] * len(decision_chunks)
 
-            # Set distances to None for new chunk
-            distances = None
+        for idx, (chunk_decision, chunk_contexts) in enumerate(zip(decision_chunks, context_chunks)):
 
             # Progress update
-            self.logger.info("Chunk " + str(idx + 1) + " out of " + str(len(chunk_start_index)))
+            self.logger.info("Chunk " + str(idx + 1) + " out of " + str(len(decision_chunks)))
 
-            start = idx * self._chunk_size
-            stop = min((idx+1)*self._chunk_size, len(test_decisions))
-            chunk_decision = test_decisions[start:stop]
-            chunk_contexts = test_contexts[start:stop] if test_contexts is not None else None
+            start = chunk_starts[idx]
+            stop = start + len(chunk_decision)
 
-            for name, mab in self.bandits:
+            # Calculate the distances for the new chunk
+            self._calculate_chunk_distances(metric_to_distance_bandits, chunk_contexts)
 
-                if mab.is_contextual:
-                    if isinstance(mab, (_RadiusSimulator, _KNearestSimulator)):
-                        if distances is None:
-                            distances = mab.calculate_distances(chunk_contexts)
-                        else:
-                            mab.set_distances(distances)
-                        predictions = mab.predict(chunk_contexts)
-                        expectations = mab.row_arm_to_expectation[start:stop].copy()
+            for kind in contextual_kinds:
+                name, mab = kind.name, kind.mab
 
+                predictions = mab.predict(chunk_contexts)
+                if kind.is_neighbors:
+                    self.bandit_to_expectations[name].append(mab._imp.arm_to_expectation.copy())
+                else:
+                    if kind.has_row_expectations:
+                        expectations = mab.row_arm_to_expectation[start:stop]
                     else:
-                        predictions = mab.predict(chunk_contexts)
-                        if isinstance(mab, _LSHSimulator):
-                            expectations = mab.row_arm_to_expectation[start:stop].copy()
-                        elif isinstance(mab._imp, _Neighbors):
-                            expectations = mab._imp.arm_to_expectation.copy()
-                        else:
-                            expectations = mab.predict_expectations(chunk_contexts)
+                        expectations = mab.predict_expectations(chunk_contexts)
 
                     if not isinstance(expectations, list):
                         expectations = [expectations]
-                    self.bandit_to_expectations[name] = self.bandit_to_expectations[name] + expectations
-
-                else:
-                    predictions = [mab.predict() for _ in range(len(chunk_decision))]
+                    bandit_to_row_expectations[name][start:stop] = expectations
 
                 if not isinstance(predictions, list):
                     predictions = [predictions]
 
-                self.bandit_to_predictions[name] = self.bandit_to_predictions[name] + predictions
+                bandit_to_predictions[name][start:stop] = predictions
 
-                if isinstance(mab, _NeighborsSimulator) and not self.is_quick:
-                    self.bandit_to_arm_to_stats_neighborhoods[name] = mab.neighborhood_arm_to_stat.copy()
+            # Release the distances of the chunk before the distances of the next chunk are calculated,
+            # so that a single distance matrix for each metric is held in memory at a time
+            for distance_bandits in metric_to_distance_bandits.values():
+                for mab in distance_bandits:
+                    mab.set_distances(None)
 
-        for name, mab in self.bandits:
-            nn = isinstance(mab, _NeighborsSimulator)
+        for kind in bandit_kinds:
+            name, mab, nn = kind.name, kind.mab, kind.is_nn
 
-            if not mab.is_contextual:
+            self.bandit_to_predictions[name] = bandit_to_predictions[name].tolist()
+            if name in bandit_to_row_expectations:
+                self.bandit_to_expectations[name] = bandit_to_row_expectations[name].tolist()
+            if not kind.is_contextual:
                 self.bandit_to_expectations[name] = mab._imp.arm_to_expectation.copy()
-            if isinstance(mab, _NeighborsSimulator) and not self.is_quick:
+            if nn and not self.is_quick:
                 self.bandit_to_neighborhood_size[name] = mab.neighborhood_sizes.copy()
+                self.bandit_to_arm_to_stats_neighborhoods[name] = mab.neighborhood_arm_to_stat.copy()
 
             # Evaluate the predictions
-            self.bandit_to_confusion_matrices[name].append(confusion_matrix(test_decisions,
-                                                                            self.bandit_to_predictions[name]))
+            self.bandit_to_confusion_matrices[name].append(self._get_confusion_matrix(test_decisions,
+                                                                                      self.bandit_to_predictions[name]))
 
             self.logger.info(name + " confusion matrix: " + str(self.bandit_to_confusion_matrices[name]))
 
-            if nn and not self.is_quick:
-                self.bandit_to_arm_to_stats_min[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       (self.arm_to_stats_train,
-                                                                        self.bandit_to_arm_to_stats_neighborhoods[
-                                                                            name]),
-                                                                       stat="min", start_index=0, nn=nn)
-
-                self.bandit_to_arm_to_stats_avg[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       (self.arm_to_stats_train,
-                                                                        self.bandit_to_arm_to_stats_neighborhoods[
-                                                                            name]),
-                                                                       stat="mean", start_index=0, nn=nn)
-
-                self.bandit_to_arm_to_stats_max[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       (self.arm_to_stats_train,
-                                                                        self.bandit_to_arm_to_stats_neighborhoods[
-                                                                            name]),
-                                                                       stat="max", start_index=0, nn=nn)
-            else:
-                self.bandit_to_arm_to_stats_min[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       self.arm_to_stats_train, stat="min",
-                                                                       start_index=0, nn=False)
-
-                self.bandit_to_arm_to_stats_avg[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       self.arm_to_stats_train, stat="mean",
-                                                                       start_index=0, nn=False)
-
-                self.bandit_to_arm_to_stats_max[name] = self.evaluator(self.arms,
-                                                                       test_decisions, test_rewards,
-                                                                       self.bandit_to_predictions[name],
-                                                                       self.arm_to_stats_train, stat="max",
-                                                                       start_index=0, nn=False)
+            (self.bandit_to_arm_to_stats_min[name],
+             self.bandit_to_arm_to_stats_avg[name],
+             self.bandit_to_arm_to_stats_max[name]) = self._evaluate(name, test_decisions, test_rewards,
+                                                                     self.bandit_to_predictions[name], 0, nn)
 
             self.logger.info(name + " minimum analysis " + str(self.bandit_to_arm_to_stats_min[name]))
             self.logger.info(name + " average analysis " + str(self.bandit_to_arm_to_stats_avg[name]))
@@ -1146,6 +1228,7 @@ class Simulator:
             self._get_partial_evaluation(name, 'total', test_decisions, self.bandit_to_predictions[name],
                                          test_rewards, 0, nn)
 
+            # The neighborhoods accumulate over the batches, so copy them once after the last batch
             if isinstance(mab, _NeighborsSimulator) and not self.is_quick:
                 self.bandit_to_neighborhood_size[name] = mab.neighborhood_sizes.copy()
                 self.bandit_to_arm_to_stats_neighborhoods[name] = mab.neighborhood_arm_to_stat.copy()
@@ -1164,9 +1247,30 @@ class Simulator:
             The test set contexts.
         """
 
-        # Divide the test data into batches
+        # The types of the bandits do not change between batches, so check them once
+        bandit_kinds = self._get_bandit_kinds()
+        contextual_kinds = [kind for kind in bandit_kinds if kind.is_contextual]
+
+        # The Radius and KNearest simulators share the same contexts, so the distances of each chunk
+        # are calculated once for each metric and set on all of its bandits
+        metric_to_distance_bandits = self._get_metric_to_distance_bandits()
+
+        # The predictions, and the expectations of the contextual bandits which are made for each test row,
+        # are written into arrays allocated once for the whole test set
+        n_test = len(test_decisions)
+        bandit_to_predictions = dict((name, np.empty(n_test, dtype=object)) for name, mab in self.bandits)
+        bandit_to_row_expectations = dict((kind.name, np.empty(n_test, dtype=object)) for kind in contextual_kinds)
+
+        # The evaluation of each batch reads the neighborhood stats of its rows, so refer to the lists the bandits
+        # add to while testing, which are copied once after the last batch
+        for name, mab in self.bandits:
+            if isinstance(mab, _NeighborsSimulator) and not self.is_quick:
+                self.bandit_to_arm_to_stats_neighborhoods[name] = mab.neighborhood_arm_to_stat
+
+        # Divide the test data into batches, and the batches into chunks
+        n_batches = (len(test_decisions) + self.batch_size - 1) // self.batch_size
         start = 0
-        for i in range(0, int(math.ceil(len(test_decisions) / self.batch_size))):
+        for i in range(n_batches):
             self.logger.info('Starting batch ' + str(i))
 
             # Stop at the next batch_size interval or the end of the test data
@@ -1176,78 +1280,66 @@ class Simulator:
             batch_decisions = test_decisions[start:stop]
             batch_rewards = test_rewards[start:stop]
             batch_predictions = {}
-            batch_expectations = {}
 
-            chunk_start = 0
+            # Context-free bandits do not depend on the contexts, so predict the whole batch
+            # in one vectorized call using empty contexts, instead of once for each chunk
+            for kind in bandit_kinds:
+                if not kind.is_contextual:
+                    predictions = kind.mab.predict(np.empty((len(batch_decisions), 0)))
+                    batch_predictions[kind.name] = predictions if len(batch_decisions) > 1 else [predictions]
 
             # Divide the batch into chunks
-            for j in range(0, int(math.ceil(self.batch_size / self._chunk_size))):
-                distances = None
-                chunk_stop = min(chunk_start + self._chunk_size, self.batch_size)
+            # When the distances of the batch fit in memory, it is a single chunk with one distance calculation
+            n_chunks = (len(batch_decisions) + self._chunk_size - 1) // self._chunk_size
+            for j in range(n_chunks):
+                chunk_start = j * self._chunk_size
+                chunk_stop = min(chunk_start + self._chunk_size, len(batch_decisions))
                 chunk_contexts = batch_contexts[chunk_start:chunk_stop] if batch_contexts is not None else None
-                chunk_decisions = batch_decisions[chunk_start:chunk_stop]
 
-                for name, mab in self.bandits:
+                # Calculate the distances for the new chunk
+                self._calculate_chunk_distances(metric_to_distance_bandits, chunk_contexts)
+
+                # The bandits return a single value for a single row and a list with a value for each row otherwise,
+                # so only the predictions of a single row are put into a list
+                is_single_row = chunk_stop - chunk_start == 1
+
+                for kind in contextual_kinds:
+                    name, mab = kind.name, kind.mab
 
                     if name not in batch_predictions.keys():
                         batch_predictions[name] = []
-                        batch_expectations[name] = []
-
-                    # Predict for the batch
-                    if mab.is_contextual:
-                        if isinstance(mab, (_RadiusSimulator, _KNearestSimulator)):
-                            if distances is None:
-                                distances = mab.calculate_distances(chunk_contexts)
-                                self.logger.info('Distances calculated')
-                            else:
-                                mab.set_distances(distances)
-                                self.logger.info('Distances set')
-                            predictions = mab.predict(chunk_contexts)
-                            expectations = mab.row_arm_to_expectation[start+chunk_start:start+chunk_stop].copy()
-                        else:
-                            predictions = mab.predict(chunk_contexts)
-                            if isinstance(mab, _LSHSimulator):
-                                expectations = mab.row_arm_to_expectation[start:stop].copy()
-                            else:
-                                expectations = mab.predict_expectations(chunk_contexts)
-
-                        if self.batch_size == 1:
-                            predictions = [predictions]
-
-                    else:
-                        predictions = [mab.predict() for _ in range(len(chunk_decisions))]
-                        expectations = mab._imp.arm_to_expectation.copy()
 
-                    # If a single prediction was returned, put it into a list
-                    if not isinstance(predictions, list):
+                    # Predict for the chunk
+                    predictions = mab.predict(chunk_contexts)
+                    if is_single_row:
                         predictions = [predictions]
-                    if not isinstance(expectations, list):
-                        expectations = [expectations]
+
+                    if kind.has_row_expectations:
+                        expectations = mab.row_arm_to_expectation[start+chunk_start:start+chunk_stop]
+                    else:
+                        expectations = mab.predict_expectations(chunk_contexts)
+                        if is_single_row:
+                            expectations = [expectations]
 
                     batch_predictions[name] = batch_predictions[name] + predictions
-                    batch_expectations[name] = batch_expectations[name] + expectations
 
-            for name, mab in self.bandits:
-                if not mab.is_contextual:
-                    batch_expectations[name] = [mab._imp.arm_to_expectation.copy()]
+                    # Slicing the list of row expectations already makes a new list, so write it without a copy
+                    bandit_to_row_expectations[name][start+chunk_start:start+chunk_stop] = expectations
 
-                nn = isinstance(mab, _NeighborsSimulator)
+            for kind in bandit_kinds:
+                name, mab, nn = kind.name, kind.mab, kind.is_nn
 
                 # Add predictions from this batch
-                self.bandit_to_predictions[name] = self.bandit_to_predictions[name] + batch_predictions[name]
-                self.bandit_to_expectations[name] = self.bandit_to_expectations[name] + batch_expectations[name]
-
-                if isinstance(mab, (_RadiusSimulator, _LSHSimulator)) and not self.is_quick:
-                    self.bandit_to_neighborhood_size[name] = mab.neighborhood_sizes.copy()
-                if isinstance(mab, _NeighborsSimulator) and not self.is_quick:
-                    self.bandit_to_arm_to_stats_neighborhoods[name] = mab.neighborhood_arm_to_stat.copy()
+                bandit_to_predictions[name][start:stop] = batch_predictions[name]
+                if not kind.is_contextual:
+                    self.bandit_to_expectations[name].append(mab._imp.arm_to_expectation.copy())
 
                 # Evaluate the predictions
                 self._get_partial_evaluation(name, i, batch_decisions, batch_predictions[name],
                                              batch_rewards, start, nn)
 
                 # Update the model
-                if mab.is_contextual:
+                if kind.is_contextual:
                     mab.partial_fit(batch_decisions, batch_rewards, batch_contexts)
                 else:
                     mab.partial_fit(batch_decisions, batch_rewards)
@@ -1256,6 +1348,11 @@ class Simulator:
             # Update start value for next batch
             start += self.batch_size
 
+        for kind in bandit_kinds:
+            self.bandit_to_predictions[kind.name] = bandit_to_predictions[kind.name].tolist()
+            if kind.is_contextual:
+                self.bandit_to_expectations[kind.name] = bandit_to_row_expectations[kind.name].tolist()
+
     def _run_scaler(self, train_contexts, test_contexts):
         """
         Scales the train and test contexts with the scaler provided to the simulator constructor.
@@ -1299,10 +1396,11 @@ class Simulator:
             test_decisions = self.decisions[train_size:]
             test_rewards = self.rewards[train_size:]
             test_contexts = self.contexts[train_size:] if self.contexts is not None else None
-            self.test_indices = [x for x in range(train_size, len(self.decisions))]
+            self.test_indices = list(range(train_size, len(self.decisions)))
 
         else:
-            indices = [x for x in range(len(self.decisions))]
+            # Split an index array, which sklearn indexes directly, and keep the public test indices as a list
+            indices = np.arange(len(self.decisions))
             if self.contexts is None:
 
                 train_contexts, test_contexts = None, None
@@ -1316,13 +1414,24 @@ class Simulator:
                     train_contexts, test_contexts = \
                     train_test_split(indices, self.decisions, self.rewards, self.contexts,
                                      test_size=self.test_size, random_state=self.seed)
-            self.test_indices = test_indices
+            self.test_indices = test_indices.tolist()
 
         # Use memory limits for the nearest neighbors shared distance list to determine chunk size.
         # The list without chunking contains len(test_decisions) elements
         # each of which is an np.ndarray with len(train_decisions) distances.
         # Approximate as 8 bytes per element in each numpy array to give the size of the list in GB.
-        distance_list_size = len(test_decisions) * (8 * len(train_decisions)) / 1e9
+        # A distance matrix is held for each metric of the Radius and KNearest bandits at the same time,
+        # and it is calculated by the first bandit with that metric.
+        # The input dependent metrics, and the bandits given a backend, calculate their rows in separate blocks
+        # which are then concatenated, so their distances are held twice at their peak.
+        imps = [mab._imp if isinstance(mab, MAB) else mab for name, mab in self.bandits]
+        metric_to_bytes = {}
+        for imp in imps:
+            if isinstance(imp, (_Radius, _KNearest)) and imp.metric not in metric_to_bytes:
+                is_concatenated = imp.metric in _NeighborsSimulator.input_dependent_metrics or imp.backend is not None
+                metric_to_bytes[imp.metric] = 16 if is_concatenated else 8
+        distance_bytes = max(sum(metric_to_bytes.values()), 8)
+        distance_list_size = len(test_decisions) * (distance_bytes * len(train_decisions)) / 1e9
 
         # If there is more than one test row and contexts have been provided:
         if distance_list_size > 1.0 and train_contexts is not None:
@@ -1443,8 +1552,31 @@ class Simulator:
         A dictionary of descriptive statistics.
         Dictionary has the format {'count', 'sum', 'min', 'max', 'mean', 'std'}
         """
-        return {'count': rewards.size, 'sum': rewards.sum(), 'min': rewards.min(),
-                'max': rewards.max(), 'mean': rewards.mean(), 'std': rewards.std()}
+        # The mean and the standard deviation reuse the sum, which mean() and std() would each calculate again
+        count = rewards.size
+        total = rewards.sum()
+        mean = total / count
+        std = np.sqrt(np.square(rewards - mean).sum() / count)
+
+        return {'count': count, 'sum': total, 'min': rewards.min(),
+                'max': rewards.max(), 'mean': mean, 'std': std}
+
+    @staticmethod
+    def _get_confusion_matrix(decisions: Union[np.ndarray, List[Arm]], predictions: Union[np.ndarray, List[Arm]]):
+        """Calculates the confusion matrix of the predictions against the historic decisions.
+
+        Same as sklearn.metrics.confusion_matrix, the labels are the sorted arms
+        that appear in either the decisions or the predictions.
+        Rows are the decisions and columns are the predictions.
+        """
+        decisions = np.asarray(decisions)
+        predictions = np.asarray(predictions)
+
+        # Map the arms to their index among the sorted labels and count each pair in a single pass
+        labels = np.unique(np.concatenate((decisions, predictions)))
+        n_labels = len(labels)
+        pairs = np.searchsorted(labels, decisions) * n_labels + np.searchsorted(labels, predictions)
+        return np.bincount(pairs, minlength=n_labels * n_labels).reshape(n_labels, n_labels)
 
     @staticmethod
     def _validate_args(bandits, decisions, rewards, contexts, test_size, ordered, batch_size,
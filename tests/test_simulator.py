@@ -6,12 +6,17 @@ import logging
 import math
 import numpy as np
 import pandas as pd
+from joblib import Parallel
+from scipy.spatial.distance import cdist
 
+from sklearn.metrics import confusion_matrix
 from sklearn.preprocessing import StandardScaler
 
 from mabwiser.base_mab import BaseMAB
 from mabwiser.mab import MAB, LearningPolicy, NeighborhoodPolicy
 from mabwiser.simulator import Simulator, _NeighborsSimulator, _RadiusSimulator, _KNearestSimulator, default_evaluator
+from mabwiser.simulator import _default_evaluator_stats, _LSHSimulator
+from mabwiser.utils import create_rng
 from mabwiser.greedy import _EpsilonGreedy
 
 logging.disable(logging.CRITICAL)
@@ -280,6 +285,82 @@ class TestSimulator(unittest.TestCase):
         self.assertTrue(bool(sim.bandit_to_predictions))
         self.assertTrue('total' in sim.bandit_to_arm_to_stats_max['0'].keys())
 
+    def test_context_free_offline_seeded_predictions(self):
+        rng = np.random.RandomState(seed=7)
+
+        # Context-free bandits predict the test set in one vectorized call,
+        # which fixes the seeded predictions of the randomized policies
+        sim = Simulator(bandits=[("greedy", MAB([0, 1, 2], LearningPolicy.EpsilonGreedy(epsilon=0.5), seed=11)),
+                                 ("random", MAB([0, 1, 2], LearningPolicy.Random(), seed=11)),
+                                 ("softmax", MAB([0, 1, 2], LearningPolicy.Softmax(), seed=11)),
+                                 ("thompson", MAB([0, 1, 2], LearningPolicy.ThompsonSampling(), seed=11))],
+                        decisions=[rng.randint(0, 3) for _ in range(40)],
+                        rewards=[rng.randint(0, 2) for _ in range(40)],
+                        contexts=None,
+                        scaler=None, test_size=0.5, batch_size=0,
+                        is_ordered=True, seed=7)
+        sim.run()
+
+        self.assertListEqual(sim.bandit_to_predictions["greedy"],
+                             [0, 2, 0, 1, 1, 0, 0, 2, 0, 0, 1, 0, 0, 2, 2, 0, 0, 0, 0, 0])
+        self.assertListEqual(sim.bandit_to_predictions["random"],
+                             [2, 2, 2, 0, 0, 0, 2, 1, 1, 1, 0, 0, 2, 0, 2, 0, 1, 0, 0, 0])
+        self.assertListEqual(sim.bandit_to_predictions["softmax"],
+                             [0, 0, 2, 0, 0, 1, 1, 1, 2, 1, 2, 2, 0, 2, 2, 0, 0, 1, 2, 1])
+        self.assertListEqual(sim.bandit_to_predictions["thompson"],
+                             [0, 2, 2, 0, 0, 0, 2, 2, 1, 1, 2, 0, 1, 0, 0, 0, 0, 2, 1, 2])
+
+    def test_context_free_offline_chunks(self):
+
+        class ChunkedSimulator(Simulator):
+            def _run_train_test_split(self):
+                split = super()._run_train_test_split()
+                self._chunk_size = 3
+                return split
+
+        bandit_to_predictions = []
+        for simulator in [Simulator, ChunkedSimulator]:
+            rng = np.random.RandomState(seed=7)
+            bandits = [("greedy", MAB([0, 1, 2], LearningPolicy.EpsilonGreedy(epsilon=0.5), seed=11)),
+                       ("thompson", MAB([0, 1, 2], LearningPolicy.ThompsonSampling(), seed=11)),
+                       ("softmax", MAB([0, 1, 2], LearningPolicy.Softmax(), seed=11))]
+            sim = simulator(bandits=bandits,
+                            decisions=[rng.randint(0, 3) for _ in range(40)],
+                            rewards=[rng.randint(0, 2) for _ in range(40)],
+                            contexts=None,
+                            scaler=None, test_size=0.5, batch_size=0,
+                            is_ordered=True, seed=7)
+            sim.run()
+            bandit_to_predictions.append(sim.bandit_to_predictions)
+
+        # Chunking the test set does not change the seeded predictions of the context-free bandits
+        self.assertDictEqual(bandit_to_predictions[0], bandit_to_predictions[1])
+
+    def test_context_free_online_seeded_predictions(self):
+        rng = np.random.RandomState(seed=7)
+
+        # Context-free bandits predict each batch in one vectorized call,
+        # which fixes the seeded predictions of the randomized policies
+        sim = Simulator(bandits=[("greedy", MAB([0, 1, 2], LearningPolicy.EpsilonGreedy(epsilon=0.5), seed=11)),
+                                 ("random", MAB([0, 1, 2], LearningPolicy.Random(), seed=11)),
+                                 ("softmax", MAB([0, 1, 2], LearningPolicy.Softmax(), seed=11)),
+                                 ("thompson", MAB([0, 1, 2], LearningPolicy.ThompsonSampling(), seed=11))],
+                        decisions=[rng.randint(0, 3) for _ in range(40)],
+                        rewards=[rng.randint(0, 2) for _ in range(40)],
+                        contexts=None,
+                        scaler=None, test_size=0.5, batch_size=5,
+                        is_ordered=True, seed=7)
+        sim.run()
+
+        self.assertListEqual(sim.bandit_to_predictions["greedy"],
+                             [0, 0, 0, 1, 1, 0, 0, 0, 2, 1, 0, 1, 0, 0, 0, 2, 1, 0, 1, 1])
+        self.assertListEqual(sim.bandit_to_predictions["random"],
+                             [2, 2, 2, 0, 0, 0, 2, 1, 1, 1, 0, 0, 2, 0, 2, 0, 1, 0, 0, 0])
+        self.assertListEqual(sim.bandit_to_predictions["softmax"],
+                             [0, 0, 2, 0, 0, 1, 1, 1, 2, 1, 2, 2, 0, 2, 2, 0, 0, 1, 2, 1])
+        self.assertListEqual(sim.bandit_to_predictions["thompson"],
+                             [0, 2, 0, 0, 2, 0, 1, 0, 2, 2, 0, 2, 0, 1, 0, 1, 0, 2, 2, 2])
+
     def test_mixed_offline(self):
         rng = np.random.RandomState(seed=7)
         bandits = []
@@ -887,6 +968,50 @@ class TestSimulator(unittest.TestCase):
         self.assertEqual(stats[0]['count'], 3)
         self.assertEqual(stats[1]['count'], 7)
 
+    def test_get_arm_stats_empty(self):
+        rng = np.random.RandomState(seed=7)
+        decisions = np.array([rng.randint(0, 2) for _ in range(10)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(10)])
+        sim = Simulator(bandits=[("example", MAB([0, 1], LearningPolicy.EpsilonGreedy()))],
+                        decisions=decisions, rewards=rewards, test_size=0.4, batch_size=0,
+                        is_ordered=True, seed=7)
+
+        stats = sim.get_arm_stats(np.array([]), np.array([]))
+        self.assertEqual(list(stats.keys()), [0, 1])
+        for arm in [0, 1]:
+            self.assertDictEqual(stats[arm], {'count': 0, 'sum': 0, 'min': 0, 'max': 0, 'mean': 0, 'std': 0})
+
+    def test_get_arm_stats_matches_get_stats(self):
+        rng = np.random.RandomState(seed=7)
+        decisions = np.array([rng.randint(0, 3) for _ in range(50)])
+        rewards = np.array([rng.rand() * 100 for _ in range(50)])
+        sim = Simulator(bandits=[("example", MAB([0, 1, 2, 3], LearningPolicy.EpsilonGreedy()))],
+                        decisions=decisions,
+                        rewards=rewards,
+                        test_size=0.4, batch_size=0,
+                        is_ordered=True, seed=7)
+
+        stats = sim.get_arm_stats(decisions, rewards)
+        self.assertEqual(list(stats.keys()), [0, 1, 2, 3])
+        for arm in [0, 1, 2]:
+            expected = Simulator.get_stats(rewards[decisions == arm])
+            self.assertDictEqual(stats[arm], expected)
+
+        # Arm without any decisions
+        self.assertDictEqual(stats[3], {'count': 0, 'sum': 0, 'min': 0, 'max': 0, 'mean': 0, 'std': 0})
+
+    def test_confusion_matrix_matches_sklearn(self):
+        rng = np.random.RandomState(seed=7)
+        decisions = np.array([rng.randint(0, 4) for _ in range(30)])
+        predictions = [rng.randint(1, 5) for _ in range(30)]
+        self.assertListEqual(Simulator._get_confusion_matrix(decisions, predictions).tolist(),
+                             confusion_matrix(decisions, predictions).tolist())
+
+        decisions = np.array(['b', 'a', 'c', 'a'])
+        predictions = ['a', 'a', 'c', 'd']
+        self.assertListEqual(Simulator._get_confusion_matrix(decisions, predictions).tolist(),
+                             confusion_matrix(decisions, predictions).tolist())
+
     def test_default_evaluator(self):
         rng = np.random.RandomState(seed=7)
         arms = [0, 1, 2]
@@ -999,6 +1124,19 @@ class TestSimulator(unittest.TestCase):
         eval = default_evaluator(arms, decisions, rewards, predictions, arm_to_stats, stat, start_index, nn=True)
         self.assertEqual(eval[2]['mean'], 20.75)
 
+        # Evaluating all stats at once gives the same results as the default evaluator
+        stat_to_eval = _default_evaluator_stats(arms, decisions, rewards, predictions, arm_to_stats,
+                                                ['min', 'mean', 'max'], start_index, nn=True)
+        for stat in ['min', 'mean', 'max']:
+            eval = default_evaluator(arms, decisions, rewards, predictions, arm_to_stats, stat, start_index, nn=True)
+            self.assertDictEqual(stat_to_eval[stat], eval)
+
+        stat_to_eval = _default_evaluator_stats(arms, decisions, rewards, predictions, train_stats,
+                                                ['min', 'mean', 'max'], start_index)
+        for stat in ['min', 'mean', 'max']:
+            eval = default_evaluator(arms, decisions, rewards, predictions, train_stats, stat, start_index)
+            self.assertDictEqual(stat_to_eval[stat], eval)
+
     def test_radius_all_empty_neighborhoods(self):
         rng = np.random.RandomState(seed=7)
         decisions = np.array([rng.randint(0, 2) for _ in range(10)])
@@ -1056,6 +1194,62 @@ class TestSimulator(unittest.TestCase):
         self.assertNotEqual(sim._chunk_size, len(bd))
         self.assertEqual(sim._chunk_size, 208)
 
+    def test_online_chunks(self):
+
+        class ChunkedSimulator(Simulator):
+            def _run_train_test_split(self):
+                split = super()._run_train_test_split()
+                self._chunk_size = 2
+                return split
+
+        rng = np.random.RandomState(seed=7)
+        decisions = np.array([rng.randint(0, 2) for _ in range(30)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(30)])
+        contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(30)])
+
+        bandit_to_predictions = []
+        for simulator in [Simulator, ChunkedSimulator]:
+            bandits = [('radius', MAB([0, 1], LearningPolicy.EpsilonGreedy(), NeighborhoodPolicy.Radius(1), seed=7)),
+                       ('knearest', MAB([0, 1], LearningPolicy.UCB1(), NeighborhoodPolicy.KNearest(3), seed=7)),
+                       ('lsh', MAB([0, 1], LearningPolicy.EpsilonGreedy(), NeighborhoodPolicy.LSHNearest(), seed=7))]
+            sim = simulator(bandits=bandits, decisions=decisions, rewards=rewards, contexts=contexts,
+                            test_size=0.4, batch_size=5, is_ordered=True, seed=7)
+            sim.run()
+            for name in ['radius', 'knearest', 'lsh']:
+                self.assertEqual(len(sim.bandit_to_predictions[name]), 12)
+                self.assertEqual(len(sim.bandit_to_expectations[name]), 12)
+            bandit_to_predictions.append(sim.bandit_to_predictions)
+
+        # Chunking the batches does not change the predictions
+        self.assertDictEqual(bandit_to_predictions[0], bandit_to_predictions[1])
+
+    def test_distances_by_metric(self):
+        rng = np.random.RandomState(seed=7)
+        decisions = np.array([rng.randint(0, 2) for _ in range(30)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(30)])
+        contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(30)])
+
+        def get_bandits():
+            return [('euclidean', MAB([0, 1], LearningPolicy.EpsilonGreedy(),
+                                      NeighborhoodPolicy.KNearest(3, metric='euclidean'), seed=7)),
+                    ('cosine', MAB([0, 1], LearningPolicy.EpsilonGreedy(),
+                                   NeighborhoodPolicy.KNearest(3, metric='cosine'), seed=7)),
+                    ('radius', MAB([0, 1], LearningPolicy.EpsilonGreedy(),
+                                   NeighborhoodPolicy.Radius(0.1, metric='cosine'), seed=7))]
+
+        for batch_size in [0, 5]:
+
+            # The bandits with different metrics predict the same together as on their own
+            sim = Simulator(bandits=get_bandits(), decisions=decisions, rewards=rewards, contexts=contexts,
+                            test_size=0.4, batch_size=batch_size, is_ordered=True, seed=7)
+            sim.run()
+            for bandit in get_bandits():
+                single_sim = Simulator(bandits=[bandit], decisions=decisions, rewards=rewards, contexts=contexts,
+                                       test_size=0.4, batch_size=batch_size, is_ordered=True, seed=7)
+                single_sim.run()
+                name = bandit[0]
+                self.assertListEqual(sim.bandit_to_predictions[name], single_sim.bandit_to_predictions[name])
+
     def test_negative_n_jobs(self):
         rng = np.random.RandomState(seed=7)
         decisions = np.array([rng.randint(0, 2) for _ in range(100)])
@@ -1105,6 +1299,68 @@ class TestSimulator(unittest.TestCase):
         nn2.set_distances(distances=distances)
         self.assertIs(nn1.distances, nn2.distances)
 
+    def test_neighbors_simulator_distances_match_rows(self):
+        rng = np.random.RandomState(seed=9)
+        decisions = np.array([rng.randint(0, 2) for _ in range(10)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(10)])
+        contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(10)])
+        new_contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(7)])
+
+        for metric in ['euclidean', 'cosine', 'seuclidean']:
+            nn = _NeighborsSimulator(rng, [0, 1], 2, None, _EpsilonGreedy(rng, [0, 1], 1, .05), metric, True)
+            nn.fit(decisions, rewards, contexts)
+            distances = nn.calculate_distances(contexts=new_contexts)
+            self.assertEqual(len(distances), 7)
+            for index, row in enumerate(new_contexts):
+                expected = cdist(contexts, row[np.newaxis, :], metric=metric).reshape(-1)
+                self.assertTrue(np.array_equal(distances[index], expected))
+
+    def test_neighbors_simulator_distances_backend(self):
+        rng = np.random.RandomState(seed=9)
+        decisions = np.array([rng.randint(0, 2) for _ in range(10)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(10)])
+        contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(10)])
+        new_contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(7)])
+
+        # A backend given to the bandit is used for the distances
+        for backend in [None, 'threading']:
+            nn = _NeighborsSimulator(rng, [0, 1], 2, backend, _EpsilonGreedy(rng, [0, 1], 1, .05), 'euclidean', True)
+            nn.fit(decisions, rewards, contexts)
+            with patch('mabwiser.simulator.Parallel', wraps=Parallel) as parallel:
+                distances = nn.calculate_distances(contexts=new_contexts)
+            self.assertEqual(parallel.call_args.kwargs.get('backend'), backend)
+            self.assertTrue(np.array_equal(distances, cdist(new_contexts, contexts, metric='euclidean')))
+
+    def test_neighbors_simulator_distances_unscaled(self):
+        rng = np.random.RandomState(seed=9)
+        decisions = np.array([rng.randint(0, 2) for _ in range(10)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(10)])
+        contexts = 1e4 + np.array([[rng.rand() for _ in range(5)] for _ in range(10)])
+        new_contexts = contexts[:3] + 0.001
+
+        # Distances of large contexts that are close to each other are calculated without cancellation
+        nn = _NeighborsSimulator(rng, [0, 1], 2, None, _EpsilonGreedy(rng, [0, 1], 1, .05), 'euclidean', True)
+        nn.fit(decisions, rewards, contexts)
+        distances = nn.calculate_distances(contexts=new_contexts)
+        for index, row in enumerate(new_contexts):
+            expected = cdist(contexts, row[np.newaxis, :], metric='euclidean').reshape(-1)
+            self.assertTrue(np.array_equal(distances[index], expected))
+            self.assertAlmostEqual(distances[index][index], 0.001 * math.sqrt(5), places=6)
+
+    def test_lsh_simulator_neighbors_match_rows(self):
+        rng = np.random.RandomState(seed=9)
+        decisions = np.array([rng.randint(0, 2) for _ in range(30)])
+        rewards = np.array([rng.randint(0, 100) for _ in range(30)])
+        contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(30)])
+        new_contexts = np.array([[rng.rand() for _ in range(5)] for _ in range(12)])
+
+        lsh = _LSHSimulator(create_rng(7), [0, 1], 1, None, _EpsilonGreedy(rng, [0, 1], 1, .05), 3, 2, True)
+        lsh.fit(decisions, rewards, contexts)
+        row_to_indices = lsh._get_neighbors_of_contexts(new_contexts)
+        self.assertEqual(len(row_to_indices), 12)
+        for index, row in enumerate(new_contexts):
+            self.assertListEqual(row_to_indices[index], list(set(lsh._get_neighbors(row[np.newaxis, :]))))
+
     def test_neighbors_simulator_copy_lp(self):
         rng = np.random.RandomState(seed=7)
         bandits = [('1', MAB([0, 1], LearningPolicy.EpsilonGreedy(), NeighborhoodPolicy.Radius()))]